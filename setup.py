@@ -1,3 +1,5 @@
+import warnings
+
 import setuptools
 
 with open("README.md", "r") as fh:
@@ -5,6 +7,25 @@ with open("README.md", "r") as fh:
 with open("requirements.txt", "r") as fh:
     requirements = [line.strip() for line in fh]
 
+# The compiled recurrence is optional: Cython and scipy are declared as build
+# requirements in pyproject.toml, but without them, or if cythonize or the
+# compilation fails (e.g. no compiler), the numba or Python kernels are used.
+try:
+    from Cython.Build import cythonize
+
+    ext_modules = cythonize(
+        [
+            setuptools.Extension(
+                "simple_esn._recurrence",
+                ["simple_esn/_recurrence.pyx"],
+                optional=True,
+            )
+        ]
+    )
+except Exception as e:
+    warnings.warn("Compiled recurrence not built: %s" % e)
+    ext_modules = []
+
 setuptools.setup(
     name="simple_esn",
     version="1.0",
@@ -15,11 +36,13 @@ setuptools.setup(
     long_description=long_description,
     long_description_content_type="text/x-rst",
     packages=setuptools.find_packages(),
+    ext_modules=ext_modules,
     classifiers=[
         "Programming Language :: Python :: 3",
         "License :: OSI Approved :: GNU General Public License v3 (GPLv3)",
         "Operating System :: OS Independent",
     ],
     python_requires='>=3.5',
-    install_requires=requirements
+    install_requires=requirements,
+    extras_require={"numba": ["numba"]},
 )
@@ -0,0 +1,83 @@
+# cython: language_level=3, boundscheck=False, wraparound=False, cdivision=True
+"""Compiled recurrence of the dense reservoir
+"""
+
+# Copyright (C) 2015 Sylvain Chevallier <sylvain.chevallier@uvsq.fr>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from cython cimport floating
+from libc.math cimport tanh, tanhf
+from scipy.linalg.cython_blas cimport dgemv, sgemv
+
+import numpy as np
+
+
+cdef inline floating _tanh_approx(floating x) noexcept nogil:
+    # Same clipped Pade approximation as simple_esn._reservoir._tanh_approx
+    if x > 3:
+        x = 3
+    elif x < -3:
+        x = -3
+    return x * (27 + x * x) / (27 + 9 * x * x)
+
+
+cdef inline void _gemv(
+    int n, floating *W, floating *curr, floating *z
+) noexcept nogil:
+    # z += W @ curr. With the Fortran layout, the C-contiguous W is seen as
+    # its transpose, hence trans="T".
+    cdef char trans = b"T"
+    cdef int inc = 1
+    cdef floating one = 1
+    if floating is double:
+        dgemv(&trans, &n, &n, &one, W, &n, curr, &inc, &one, z, &inc)
+    else:
+        sgemv(&trans, &n, &n, &one, W, &n, curr, &inc, &one, z, &inc)
+
+
+def run(
+    floating[:, ::1] Uproj,
+    floating[:, ::1] W,
+    double damping,
+    floating[:, :] states,
+    bint fast_tanh=False,
+):
+    """Iterate the leaky reservoir update over all time steps
+
+    Same contract as simple_esn._reservoir._run_reservoir for a dense W,
+    states may be a strided view.
+    """
+    cdef int n_samples = states.shape[0]
+    cdef int n_components = states.shape[1]
+    cdef floating d = damping
+    cdef floating leak = 1 - damping
+    cdef floating a
+    cdef floating[::1] curr = np.zeros(n_components, dtype=np.asarray(W).dtype)
+    cdef floating *z
+    cdef int t, i
+
+    with nogil:
+        for t in range(n_samples):
+            z = &Uproj[t, 0]
+            _gemv(n_components, &W[0, 0], &curr[0], z)
+            for i in range(n_components):
+                if fast_tanh:
+                    a = _tanh_approx(z[i])
+                elif floating is double:
+                    a = tanh(z[i])
+                else:
+                    a = tanhf(z[i])
+                curr[i] = leak * curr[i] + d * a
+                states[t, i] = curr[i]
@@ -0,0 +1,421 @@
+"""Recurrence kernels of the reservoir
+"""
+
+# Copyright (C) 2015 Sylvain Chevallier <sylvain.chevallier@uvsq.fr>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from typing import Union
+
+import numpy as np
+from scipy import sparse
+
+try:
+    from numba import njit
+
+    HAS_NUMBA = True
+except ImportError:  # numba is optional, kernels run as plain Python
+    HAS_NUMBA = False
+
+    def njit(*args, **kwargs):
+        def decorator(func):
+            return func
+
+        return decorator
+
+try:
+    from simple_esn._recurrence import run as _run_compiled
+except ImportError:  # the Cython extension is optional
+    _run_compiled = None
+
+
+@njit(cache=True, fastmath=True)
+def _tanh_approx(x: np.ndarray) -> np.ndarray:
+    """Rational (Pade) approximation of the hyperbolic tangent
+
+    Input is clipped to [-3, 3], where the approximation reaches exactly -1
+    and 1. Absolute error is below 0.025, which is harmless for a random
+    reservoir and several times cheaper than the libm tanh.
+    """
+    x = np.minimum(np.maximum(x, -3.0), 3.0)
+    x2 = x * x
+    return x * (27.0 + x2) / (27.0 + 9.0 * x2)
+
+
+@njit(cache=True, fastmath=True)
+def _leaky_update(
+    curr: np.ndarray, z: np.ndarray, damping: float, leak: float, fast_tanh: bool
+) -> None:
+    """Blend in place the state with the activation of the pre-activation z
+
+    Only in-place operations, no temporary array is allocated and the state
+    stays in the dtype of the input.
+    """
+    if fast_tanh:
+        z[:] = _tanh_approx(z)
+    else:
+        np.tanh(z, z)
+    np.multiply(curr, leak, curr)
+    np.multiply(z, damping, z)
+    np.add(curr, z, curr)
+
+
+@njit(cache=True, fastmath=True)
+def _run_dense(
+    Uproj: np.ndarray,
+    W: np.ndarray,
+    damping: float,
+    states: np.ndarray,
+    fast_tanh: bool = False,
+) -> None:
+    n_samples, n_components = states.shape
+    leak = 1 - damping
+    curr = np.zeros(n_components, dtype=states.dtype)
+    for t in range(n_samples):
+        z = Uproj[t]
+        z += W @ curr
+        _leaky_update(curr, z, damping, leak, fast_tanh)
+        states[t] = curr
+
+
+@njit(cache=True, fastmath=True)
+def _run_csr(
+    Uproj: np.ndarray,
+    data: np.ndarray,
+    indices: np.ndarray,
+    indptr: np.ndarray,
+    damping: float,
+    states: np.ndarray,
+    fast_tanh: bool = False,
+) -> None:
+    n_samples, n_components = states.shape
+    leak = 1 - damping
+    curr = np.zeros(n_components, dtype=states.dtype)
+    for t in range(n_samples):
+        z = Uproj[t]
+        for i in range(n_components):
+            for j in range(indptr[i], indptr[i + 1]):
+                z[i] += data[j] * curr[indices[j]]
+        _leaky_update(curr, z, damping, leak, fast_tanh)
+        states[t] = curr
+
+
+def _run_reservoir(
+    Uproj: np.ndarray,
+    W: Union[np.ndarray, sparse.csr_matrix],
+    damping: float,
+    states: np.ndarray,
+    fast_tanh: bool = False,
+) -> None:
+    """Iterate the leaky reservoir update over all time steps
+
+    Parameters
+    ----------
+    Uproj : array, shape (n_samples, n_components)
+        Input projection of each time step, including the bias. It is
+        computed once for all steps and used as a workspace, its content is
+        overwritten.
+
+    W : array or CSR matrix, shape (n_components, n_components)
+        Weight matrix of the reservoir.
+
+    damping : float
+        Damping (forget) factor of the leaky integration.
+
+    states : array, shape (n_samples, n_components)
+        Output array, filled with the activation of the reservoir neurons at
+        each time step. Each step is a contiguous row store.
+
+    fast_tanh : bool, optional
+        Use the approximation of tanh, see _tanh_approx.
+    """
+    if sparse.issparse(W):
+        if HAS_NUMBA:
+            _run_csr(Uproj, W.data, W.indices, W.indptr, damping, states, fast_tanh)
+        else:
+            # Plain Python kernel, W @ curr is the scipy sparse product,
+            # much faster than an interpreted CSR loop.
+            _run_dense(Uproj, W, damping, states, fast_tanh)
+    elif _run_compiled is not None and W.dtype in (np.float32, np.float64):
+        _run_compiled(Uproj, W, damping, states, fast_tanh)
+    else:
+        _run_dense(Uproj, W, damping, states, fast_tanh)
+
+
+def _run_reservoir_batch(
+    Uproj: np.ndarray,
+    W: Union[np.ndarray, sparse.csr_matrix],
+    damping: float,
+    states: np.ndarray,
+    fast_tanh: bool = False,
+) -> None:
+    """Iterate the reservoir update for a batch of independent timeseries
+
+    Same as _run_reservoir, with Uproj and states of shape
+    (n_samples, n_series, n_components). The state holds one column per
+    timeserie, so that the recurrent product of a step is a single gemm
+    W @ curr, written in a preallocated buffer.
+
+    The time loop is not compiled: with n_series columns per step the
+    interpreter overhead is amortised, and the numpy tanh is SIMD
+    vectorized whereas the numba one is not.
+    """
+    n_samples, n_series, n_components = states.shape
+    leak = 1 - damping
+    curr = np.zeros((n_components, n_series), dtype=states.dtype)
+    z = np.empty_like(curr)
+    for t in range(n_samples):
+        if sparse.issparse(W):
+            z[...] = W @ curr
+        else:
+            np.matmul(W, curr, out=z)
+        z += Uproj[t].T
+        if fast_tanh:
+            z[...] = _tanh_approx(z)
+        else:
+            np.tanh(z, z)
+        curr *= leak
+        z *= damping
+        curr += z
+        states[t] = curr.T
+
+
+@njit(cache=True, fastmath=True)
+def _linear_recurrence(a: np.ndarray, b: np.ndarray) -> None:
+    """Solve in place h_t = a * h_{t-1} + b_t, with h_{-1} = 0
+
+    The first axis of b is time, a broadcasts over the others. Sequential
+    loop, O(n_samples * n_components) work, the fastest on CPU.
+    """
+    for t in range(1, b.shape[0]):
+        b[t] += a * b[t - 1]
+
+
+def _linear_scan(a, b) -> None:
+    """Solve in place h_t = a * h_{t-1} + b_t, with h_{-1} = 0
+
+    Same as _linear_recurrence, for numpy, cupy or torch arrays. As the
+    recurrence is linear and a is constant, it is an associative scan
+    computed by parallel prefix (Hillis-Steele): ceil(log2(n_samples))
+    element-wise passes over the whole timeserie. This is O(n_samples *
+    log(n_samples) * n_components) work, but each pass is parallel over
+    time steps, which suits a GPU.
+    """
+    step, a_step = 1, a
+    while step < b.shape[0]:
+        b[step:] += a_step * b[:-step]
+        a_step = a_step * a_step
+        step *= 2
+
+
+def _run_diagonal(
+    Uproj: np.ndarray,
+    eigenvalues: np.ndarray,
+    mixing: np.ndarray,
+    damping: float,
+    states: np.ndarray,
+    fast_tanh: bool = False,
+) -> None:
+    """Update of the diagonal reservoir
+
+    The reservoir is linear with a complex diagonal weight matrix, its
+    recurrence is element-wise and cheap (_linear_recurrence). The
+    non-linearity is applied afterward, for all time steps at once, by a
+    random mixing layer of tanh units on the real part of the linear
+    states. On GPU, the linear recurrence is a parallel scan instead, see
+    _gpu_diagonal.
+
+    Parameters
+    ----------
+    Uproj : array, shape (n_samples, ..., n_components)
+        Input projection of each time step, including the bias.
+
+    eigenvalues : complex array, shape (n_components,)
+        Diagonal of the reservoir weight matrix.
+
+    mixing : array, shape (n_components, n_components)
+        Weights of the mixing layer.
+
+    damping : float
+        Damping (forget) factor of the leaky integration.
+
+    states : array, same shape as Uproj
+        Output array, filled with the activation of the mixing layer.
+
+    fast_tanh : bool, optional
+        Use the approximation of tanh, see _tanh_approx.
+    """
+    h = Uproj.astype(eigenvalues.dtype)
+    h *= damping
+    _linear_recurrence((1 - damping) + damping * eigenvalues, h)
+    states[...] = h.real @ mixing.T
+    if fast_tanh:
+        states[...] = _tanh_approx(states)
+    else:
+        np.tanh(states, states)
+
+
+def _gpu_activation(xp, z, fast_tanh: bool):
+    if fast_tanh:
+        z = z.clip(-3, 3)
+        z2 = z * z
+        return z * (27 + z2) / (27 + 9 * z2)
+    return xp.tanh(z)
+
+
+def _gpu_recurrence(xp, Uproj, W, damping: float, fast_tanh: bool):
+    """Iterate the reservoir update on device arrays
+
+    Same update as the CPU kernels, written with the array API shared by
+    numpy, cupy and torch. Uproj has shape (n_samples, n_series,
+    n_components), the state is (n_series, n_components) and W @ curr.T is
+    a gemv or a gemm on the device, dense or sparse. Returns the states, of
+    the same shape as Uproj.
+    """
+    leak = 1 - damping
+    curr = xp.zeros_like(Uproj[0])
+    states = xp.empty_like(Uproj)
+    for t in range(Uproj.shape[0]):
+        z = _gpu_activation(xp, Uproj[t] + (W @ curr.T).T, fast_tanh)
+        curr = leak * curr + damping * z
+        states[t] = curr
+    return states
+
+
+def _gpu_diagonal(xp, Uproj, eigenvalues, mixing, damping: float, fast_tanh: bool):
+    """Update of the diagonal reservoir on device arrays
+
+    Same as _run_diagonal, with the array API shared by numpy, cupy and
+    torch, and the linear recurrence solved by the parallel scan
+    _linear_scan. Returns the states, of the same shape as Uproj.
+    """
+    # A Python complex keeps the precision of Uproj (complex64 for float32)
+    h = Uproj * complex(damping)
+    _linear_scan((1 - damping) + damping * eigenvalues, h)
+    return _gpu_activation(xp, h.real @ mixing.T, fast_tanh)
+
+
+def _gpu_module(backend: str):
+    """Import the array library of a GPU backend, 'cupy' or 'torch'
+
+    Also checks that a CUDA device is available, as torch and cupy can be
+    installed without one.
+    """
+    try:
+        if backend == "cupy":
+            import cupy
+            import cupyx.scipy.sparse  # noqa: F401
+
+            xp = cupy
+        else:
+            import torch
+
+            xp = torch
+    except ImportError:
+        raise ImportError(
+            "backend=%r requires %s to be installed" % (backend, backend)
+        )
+    if backend == "cupy":
+        try:
+            has_device = xp.cuda.runtime.getDeviceCount() > 0
+        except xp.cuda.runtime.CUDARuntimeError:  # no driver
+            has_device = False
+    else:
+        has_device = xp.cuda.is_available()
+    if not has_device:
+        raise RuntimeError("backend=%r requires a CUDA device" % (backend,))
+    return xp
+
+
+def _to_device(xp, a):
+    """Copy a numpy array or a scipy CSR matrix to the CUDA device"""
+    if xp.__name__ == "cupy":
+        if sparse.issparse(a):
+            import cupyx.scipy.sparse
+
+            return cupyx.scipy.sparse.csr_matrix(a)
+        return xp.asarray(a)
+    if sparse.issparse(a):
+        return xp.sparse_csr_tensor(
+            xp.as_tensor(a.indptr, dtype=xp.int64),
+            xp.as_tensor(a.indices, dtype=xp.int64),
+            xp.as_tensor(a.data),
+            size=a.shape,
+            device="cuda",
+        )
+    return xp.as_tensor(np.ascontiguousarray(a), device="cuda")
+
+
+def _to_host(xp, a) -> np.ndarray:
+    if xp.__name__ == "cupy":
+        return xp.asnumpy(a)
+    return a.cpu().numpy()
+
+
+def _run_gpu(
+    xp,
+    x: np.ndarray,
+    device_weights: dict,
+    damping: float,
+    states: np.ndarray,
+    fast_tanh: bool = False,
+    mode: str = "dense",
+) -> None:
+    """Project the input and iterate the reservoir update on a CUDA device
+
+    Parameters
+    ----------
+    xp : module
+        Array library of the device, cupy or torch.
+
+    x : array, shape (n_samples * n_series, n_features)
+        Input, time-major for a batch. Only x is transferred to the device,
+        the input projection is computed there.
+
+    device_weights : dict
+        Device copies of the weights, kept by the estimator between calls:
+        'W' the reservoir (its diagonal for the diagonal mode), 'Win' the
+        input weights without bias, 'bias', and 'mixing' the mixing layer
+        for the diagonal mode.
+
+    damping : float
+        Damping (forget) factor of the leaky integration.
+
+    states : array, shape (n_samples, n_components) or
+        (n_samples, n_series, n_components)
+        Output array, filled with the activation of the reservoir neurons.
+
+    fast_tanh : bool, optional
+        Use the approximation of tanh, see _tanh_approx.
+
+    mode : {'dense', 'diagonal'}, optional
+        Kind of reservoir, see SimpleESN.
+    """
+    x = _to_device(xp, x)
+    Uproj = x @ device_weights["Win"].T + device_weights["bias"]
+    n_samples, n_components = states.shape[0], states.shape[-1]
+    Uproj = Uproj.reshape(n_samples, -1, n_components)
+    damping = float(damping)
+    if mode == "diagonal":
+        result = _gpu_diagonal(
+            xp,
+            Uproj,
+            device_weights["W"],
+            device_weights["mixing"],
+            damping,
+            fast_tanh,
+        )
+    else:
+        result = _gpu_recurrence(xp, Uproj, device_weights["W"], damping, fast_tanh)
+    states[...] = _to_host(xp, result).reshape(states.shape)
@@ -17,13 +17,77 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 # TODO: add n_readout = -1 for n_readout = n_components
-from typing import Callable, Optional
+from typing import Callable, Optional, Union
 
 import numpy as np
 import scipy.linalg as la
+from scipy import sparse
+from scipy.sparse.csgraph import connected_components
+from scipy.sparse.linalg import ArpackNoConvergence, eigs
 from sklearn.base import BaseEstimator, TransformerMixin
 from sklearn.utils import check_array, check_random_state
 
+from simple_esn._reservoir import (
+    _run_diagonal,
+    _gpu_module,
+    _run_gpu,
+    _to_device,
+    _run_reservoir,
+    _run_reservoir_batch,
+)
+
+# Below this size, a dense LAPACK call is cheaper than ARPACK iterations
+_ARPACK_MIN_SIZE = 50
+# Random reservoirs have many eigenvalues of similar modulus, ARPACK with a
+# single eigenvalue or a too small Krylov subspace converges to a
+# non-dominant one. A few eigenvalues are computed, with a subspace growing
+# with the size of the reservoir.
+_ARPACK_K = 10
+_ARPACK_MIN_NCV = 40
+# Number of draws of a sparse reservoir before giving up on a nilpotent one
+_MAX_SPARSE_DRAWS = 10
+
+
+def _spectral_radius(weights: Union[np.ndarray, sparse.csr_matrix]) -> float:
+    """Largest absolute eigenvalue of a square weight matrix
+
+    Only the dominant eigenvalue is needed, so ARPACK (Arnoldi iterations) is
+    used instead of a full eigendecomposition, except for small matrices.
+    """
+    n = weights.shape[0]
+    if n >= _ARPACK_MIN_SIZE:
+        try:
+            eigenvalues = eigs(
+                weights,
+                k=_ARPACK_K,
+                which="LM",
+                ncv=min(n, max(_ARPACK_MIN_NCV, int(2 * np.sqrt(n)))),
+                v0=np.ones(n, dtype=weights.dtype),
+                maxiter=300,
+                tol=1e-4,
+                return_eigenvectors=False,
+            )
+            return float(np.max(np.abs(eigenvalues)))
+        except ArpackNoConvergence:
+            pass
+    if sparse.issparse(weights):
+        weights = weights.toarray()
+    # The random weights are finite by construction, skip the scan
+    return float(np.max(np.abs(la.eigvals(weights, check_finite=False))))
+
+
+def _is_nilpotent(weights: sparse.csr_matrix) -> bool:
+    """Whether the sparsity pattern forces a zero spectral radius
+
+    A matrix whose connection graph has no cycle is nilpotent, whatever its
+    values. This is checked on the structure rather than on the computed
+    radius, which is only zero up to numerical errors.
+    """
+    n_components, _ = connected_components(
+        weights, directed=True, connection="strong"
+    )
+    return n_components == weights.shape[0] and not weights.diagonal().any()
+
 
 class SimpleESN(BaseEstimator, TransformerMixin):
     """Simple Echo State Network (ESN)
@@ -58,13 +122,52 @@ class SimpleESN(BaseEstimator, TransformerMixin):
     random_state : integer or numpy.RandomState, optional
         Random number generator instance. If integer, fixes the seed.
 
+    fast_tanh : bool, optional
+        Use a rational approximation of tanh for the neuron activation,
+        faster but with an absolute error up to 0.025. Default is False.
+
+    density : float, optional
+        Proportion of non-zero connections in the reservoir. Below 1, the
+        weight matrix is stored as a scipy CSR sparse matrix, classical ESN
+        use a density of a few percents. Default is 1, a dense reservoir.
+
+    mode : {'dense', 'diagonal'}, optional
+        Kind of reservoir. 'dense' is the classical ESN with a random weight
+        matrix (sparse if density < 1). 'diagonal' is a linear reservoir with
+        a complex diagonal weight matrix followed by a random mixing layer
+        of tanh units, as in ParalESN: the recurrence is element-wise and
+        the tanh units are computed for all time steps at once. On the GPU
+        backends, the linear recurrence is also parallel over time steps.
+        Without tanh in the recurrence, states diverge unless weight_scaling
+        is below 1, and density must be 1. Default is 'dense'.
+
+    backend : {'numpy', 'cupy', 'torch'}, optional
+        Library running the reservoir recurrence. 'cupy' and 'torch' run it
+        on a CUDA device, which is much faster for large reservoirs. These
+        GPU backends are experimental. Echoes are always returned as numpy
+        arrays. Default is 'numpy'.
+
+    check_input : bool, optional
+        Validate the input with sklearn check_array, which scans it for NaN
+        and infinite values. Set to False to skip this full pass on inputs
+        known to be valid, they are then only converted to dtype.
+        Default is True.
+
+    dtype : {numpy.float32, numpy.float64}, optional
+        Floating point type of the weights and activations, default is
+        float32 which halves the memory traffic compared to float64.
+
     Attributes
     ----------
     input_weights_ : array_like, shape (n_features,)
         Weight of the input units
 
-    weights_ : array_Like, shape (n_components, n_components)
-        Weight matrix for the reservoir
+    weights_ : array_Like or CSR matrix, shape (n_components, n_components)
+        Weight matrix for the reservoir. With mode='diagonal', complex array
+        of shape (n_components,), the diagonal of the weight matrix.
+
+    mixing_weights_ : array_like, shape (n_components, n_components)
+        Weights of the mixing layer with mode='diagonal', None otherwise
 
     components_ : array_like, shape (n_samples, 1+n_features+n_components)
         Activation of the n_components reservoir neurons, including the
@@ -74,6 +177,9 @@ class SimpleESN(BaseEstimator, TransformerMixin):
     readout_idx_ : array_like, shape (n_readout,)
         Index of the randomly selected readout neurons
 
+    spectral_radius_ : float
+        Spectral radius of the random reservoir matrix before scaling
+
     Example
     -------
 
@@ -94,6 +200,12 @@ class SimpleESN(BaseEstimator, TransformerMixin):
         weight_scaling: float = 0.9,
         discard_steps: int = 0,
         random_state: Optional[int] = None,
+        fast_tanh: bool = False,
+        density: float = 1.0,
+        mode: str = "dense",
+        backend: str = "numpy",
+        check_input: bool = True,
+        dtype: type = np.float32,
     ) -> None:
 
         self.n_readout = n_readout
@@ -102,42 +214,235 @@ class SimpleESN(BaseEstimator, TransformerMixin):
         self.weight_scaling = weight_scaling
         self.discard_steps = discard_steps
         self.random_state = check_random_state(random_state)
+        self.fast_tanh = fast_tanh
+        self.density = density
+        self.mode = mode
+        self.backend = backend
+        self.check_input = check_input
+        self.dtype = dtype
         self.input_weights_ = None
         self.readout_idx_ = None
         self.weights_ = None
-
-    def _fit_transform(self, x: np.ndarray) -> Callable:
-        n_samples, n_features = x.shape
-        x = check_array(x, ensure_2d=True)
-        self.weights_ = (
-            self.random_state.rand(self.n_components, self.n_components) - 0.5
+        self.mixing_weights_ = None
+        self.spectral_radius_ = None
+        self._Uproj_buf = None
+        self._device_weights = None
+
+    def _check_input(self, x: np.ndarray, allow_nd: bool = False) -> np.ndarray:
+        # The kernels are only compiled for single and double precision
+        if np.dtype(self.dtype) not in (np.float32, np.float64):
+            raise ValueError(
+                "dtype should be float32 or float64, got %r" % (self.dtype,)
+            )
+        if not self.check_input:
+            return np.ascontiguousarray(x, dtype=self.dtype)
+        return check_array(x, allow_nd=allow_nd, dtype=self.dtype)
+
+    def _check_backend(self) -> None:
+        # Before any weight is drawn, so that a wrong backend fails fast
+        if self.backend not in ("numpy", "cupy", "torch"):
+            raise ValueError(
+                "backend should be 'numpy', 'cupy' or 'torch', got %r"
+                % (self.backend,)
+            )
+        if self.backend != "numpy":
+            _gpu_module(self.backend)
+
+    def _run_device(self, x: np.ndarray, states: np.ndarray) -> None:
+        xp = _gpu_module(self.backend)
+        # Device copies of the weights are kept until the weights change, so
+        # that repeated transform calls only transfer the input.
+        cache = self._device_weights
+        if (
+            cache is None
+            or cache[0] != self.backend
+            or cache[1] is not self.weights_
+            or cache[2] is not self.input_weights_
+            or cache[3] is not self.mixing_weights_
+        ):
+            device_weights = {
+                "W": _to_device(xp, self.weights_),
+                "Win": _to_device(xp, self.input_weights_[:, 1:]),
+                "bias": _to_device(xp, self.input_weights_[:, 0]),
+            }
+            if self.mixing_weights_ is not None:
+                device_weights["mixing"] = _to_device(xp, self.mixing_weights_)
+            cache = (
+                self.backend,
+                self.weights_,
+                self.input_weights_,
+                self.mixing_weights_,
+                device_weights,
+            )
+            self._device_weights = cache
+        damping = states.dtype.type(self.damping)
+        _run_gpu(xp, x, cache[4], damping, states, self.fast_tanh, self.mode)
+
+    def _uniform_weights(self, *shape: int) -> np.ndarray:
+        dtype = np.dtype(self.dtype)
+        weights = self.random_state.rand(*shape).astype(dtype, copy=False)
+        # In place, the reservoir matrix can be large
+        weights -= dtype.type(0.5)
+        return weights
+
+    def _reservoir_weights(self) -> Union[np.ndarray, sparse.csr_matrix]:
+        if self.mode not in ("dense", "diagonal"):
+            raise ValueError(
+                "mode should be 'dense' or 'diagonal', got %r" % (self.mode,)
+            )
+        if not 0 < self.density <= 1:
+            raise ValueError("density should be in ]0, 1], got %r" % (self.density,))
+        if self.mode == "diagonal":
+            # The linear recurrence has rate (1 - damping) + damping * lambda,
+            # of modulus below 1 for all damping only if |lambda| < 1
+            if not self.weight_scaling < 1:
+                raise ValueError(
+                    "mode='diagonal' requires weight_scaling < 1, got %r"
+                    % (self.weight_scaling,)
+                )
+            if self.density != 1:
+                raise ValueError(
+                    "mode='diagonal' requires density=1, got %r" % (self.density,)
+                )
+            # Eigenvalues uniformly distributed in the unit disk
+            modulus = np.sqrt(self.random_state.rand(self.n_components))
+            phase = 2 * np.pi * self.random_state.rand(self.n_components)
+            weights = (modulus * np.exp(1j * phase)).astype(
+                np.result_type(self.dtype, np.complex64)
+            )
+            self.spectral_radius_ = float(np.max(modulus))
+        elif self.density < 1:
+            weights = self._sparse_weights()
+        else:
+            weights = self._uniform_weights(self.n_components, self.n_components)
+        if self.mode == "dense":
+            self.spectral_radius_ = _spectral_radius(weights)
+        # In place for dense, diagonal and CSR (on its data) weights
+        weights *= self.weight_scaling / self.spectral_radius_
+        return weights
+
+    def _sparse_weights(self) -> sparse.csr_matrix:
+        for _ in range(_MAX_SPARSE_DRAWS):
+            # rng and data sampler are positional for compatibility between
+            # scipy versions
+            weights = sparse.random(
+                self.n_components,
+                self.n_components,
+                self.density,
+                "csr",
+                np.dtype(self.dtype),
+                self.random_state,
+                lambda k: self.random_state.rand(k) - 0.5,
+            )
+            # A nilpotent reservoir has no echo and cannot be scaled
+            if not _is_nilpotent(weights):
+                return weights
+        raise ValueError(
+            "Sparse reservoir with n_components=%d and density=%r has a zero "
+            "spectral radius in %d draws, increase density or n_components"
+            % (self.n_components, self.density, _MAX_SPARSE_DRAWS)
         )
 
-        spectral_radius = np.max(np.abs(la.eig(self.weights_)[0]))
-        self.weights_ *= self.weight_scaling / spectral_radius
-
-        self.input_weights_ = (
-            self.random_state.rand(self.n_components, 1 + n_features) - 0.5
-        )
+    def _mixing_weights(self) -> Optional[np.ndarray]:
+        if self.mode != "diagonal":
+            return None
+        mixing = self._uniform_weights(self.n_components, self.n_components)
+        mixing /= _spectral_radius(mixing)
+        return mixing
+
+    def _run(self, Uproj: np.ndarray, states: np.ndarray) -> None:
+        damping = states.dtype.type(self.damping)
+        if self.mode == "diagonal":
+            _run_diagonal(
+                Uproj,
+                self.weights_,
+                self.mixing_weights_,
+                damping,
+                states,
+                self.fast_tanh,
+            )
+        elif states.ndim == 3:
+            _run_reservoir_batch(Uproj, self.weights_, damping, states, self.fast_tanh)
+        else:
+            _run_reservoir(Uproj, self.weights_, damping, states, self.fast_tanh)
 
-        self.readout_idx_ = self.random_state.permutation(
-            np.arange(1 + n_features, 1 + n_features + self.n_components)
-        )[: self.n_readout]
+    def _ensure_initialized(self, n_features: int) -> None:
+        if self.weights_ is None:
+            self.weights_ = self._reservoir_weights()
 
-        self.components_ = np.zeros(
-            shape=(1 + n_features + self.n_components, n_samples)
-        )
+        if self.input_weights_ is None:
+            self.input_weights_ = self._uniform_weights(
+                self.n_components, 1 + n_features
+            )
 
-        curr_ = np.zeros(shape=(self.n_components, 1))
-        U = np.concatenate((np.ones(shape=(n_samples, 1)), x), axis=1)
+        if self.mixing_weights_ is None:
+            self.mixing_weights_ = self._mixing_weights()
 
-        for t in range(n_samples):
-            u = np.array(U[t, :], ndmin=2).T
-            curr_ = (1 - self.damping) * curr_ + self.damping * np.tanh(
-                self.input_weights_.dot(u) + self.weights_.dot(curr_)
+        if self.readout_idx_ is None:
+            self.readout_idx_ = 1 + n_features + self.random_state.choice(
+                self.n_components,
+                size=min(self.n_readout, self.n_components),
+                replace=False,
             )
-            self.components_[:, t] = np.vstack((u, curr_))[:, 0]
 
+    def _init_weights(self, n_features: int) -> None:
+        self.weights_ = None
+        self.input_weights_ = None
+        self.mixing_weights_ = None
+        self.readout_idx_ = None
+        self._ensure_initialized(n_features)
+
+    def _buffer(self, name: str, n_samples: int, dtype: np.dtype) -> np.ndarray:
+        # Work arrays of shape (n_samples, n_components) are kept between
+        # calls and only grown when needed, so that repeated transform calls
+        # on timeseries of the same length do not allocate them again.
+        buffer = getattr(self, name)
+        if (
+            buffer is None
+            or buffer.shape[0] < n_samples
+            or buffer.shape[1] != self.n_components
+            or buffer.dtype != dtype
+        ):
+            buffer = np.empty((n_samples, self.n_components), dtype=dtype)
+            setattr(self, name, buffer)
+        return buffer[:n_samples]
+
+    def _project(self, x: np.ndarray, out: Optional[np.ndarray] = None) -> np.ndarray:
+        # Input projection of all time steps, Win @ [1, x_t] for each t. The
+        # bias column of input_weights_ is added by broadcasting instead of
+        # prepending a column of ones to x.
+        out = np.matmul(x, self.input_weights_[:, 1:].T, out=out)
+        out += self.input_weights_[:, 0]
+        return out
+
+    def _transform(self, x: np.ndarray) -> None:
+        n_samples, n_features = x.shape
+        shape = (n_samples, 1 + n_features + self.n_components)
+        components = getattr(self, "components_", None)
+        if (
+            components is None
+            or components.shape != shape
+            or components.dtype != x.dtype
+        ):
+            # Every entry is written below, no need to zero-fill
+            self.components_ = np.empty(shape=shape, dtype=x.dtype)
+        # Bias and input columns are set once, the kernels write the
+        # reservoir states directly in the remaining columns.
+        self.components_[:, 0] = 1
+        self.components_[:, 1 : 1 + n_features] = x
+        states = self.components_[:, 1 + n_features :]
+        if self.backend == "numpy":
+            Uproj = self._buffer("_Uproj_buf", n_samples, x.dtype)
+            self._project(x, out=Uproj)
+            self._run(Uproj, states)
+        else:
+            self._run_device(x, states)
+
+    def _fit_transform(self, x: np.ndarray) -> Callable:
+        x = self._check_input(x)
+        self._check_backend()
+        self._init_weights(x.shape[1])
+        self._transform(x)
         return self
 
     def fit(self, x: np.ndarray, y: Optional[np.ndarray] = None) -> Callable:
@@ -174,7 +479,7 @@ class SimpleESN(BaseEstimator, TransformerMixin):
             Reservoir activation generated by the readout neurons
         """
         self = self._fit_transform(x)
-        return self.components_[self.readout_idx_, self.discard_steps :].T
+        return self.components_[self.discard_steps :, self.readout_idx_]
 
     def transform(self, x: np.ndarray) -> np.ndarray:
         """Generate echoes from the reservoir
@@ -189,37 +494,49 @@ class SimpleESN(BaseEstimator, TransformerMixin):
         readout : array, shape (n_samples, n_readout)
             Reservoir activation generated by the readout neurons
         """
-        x = check_array(x, ensure_2d=True)
-        n_samples, n_features = x.shape
+        x = self._check_input(x)
+        self._check_backend()
+        self._ensure_initialized(x.shape[1])
+        self._transform(x)
 
-        if self.weights_ is None:
-            self.weights_ = (
-                self.random_state.rand(self.n_components, self.n_components) - 0.5
-            )
-            spectral_radius = np.max(np.abs(la.eig(self.weights_)[0]))
-            self.weights_ *= self.weight_scaling / spectral_radius
+        return self.components_[self.discard_steps :, self.readout_idx_]
 
-        if self.input_weights_ is None:
-            self.input_weights_ = (
-                self.random_state.rand(self.n_components, 1 + n_features) - 0.5
-            )
+    def fit_transform_batch(self, xs: np.ndarray) -> np.ndarray:
+        """Generate echoes of several independent timeseries
 
-        if self.readout_idx_ is None:
-            self.readout_idx_ = self.random_state.permutation(
-                np.arange(1 + n_features, 1 + n_features + self.n_components)
-            )[: self.n_readout]
+        The reservoir is initialized as in fit_transform, then all the
+        timeseries are processed together: at each time step, the recurrent
+        product is done for all of them at once as a matrix-matrix product.
 
-        self.components_ = np.zeros(
-            shape=(1 + n_features + self.n_components, n_samples)
-        )
-        curr_ = np.zeros(shape=(self.n_components, 1))
-        U = np.concatenate((np.ones(shape=(n_samples, 1)), x), axis=1)
+        Parameters
+        ----------
+        xs : array-like of shape [n_series, n_samples, n_features]
+            Timeseries of equal length.
 
-        for t in range(n_samples):
-            u = np.array(U[t, :], ndmin=2).T
-            curr_ = (1 - self.damping) * curr_ + self.damping * np.tanh(
-                self.input_weights_.dot(u) + self.weights_.dot(curr_)
+        Returns
+        -------
+        readout : array, shape (n_series, n_samples, n_readout)
+            Reservoir activation generated by the readout neurons for each
+            timeseries
+        """
+        xs = self._check_input(xs, allow_nd=True)
+        if xs.ndim != 3:
+            raise ValueError(
+                "Expected 3D array of shape (n_series, n_samples, n_features), "
+                "got %dD array instead" % xs.ndim
             )
-            self.components_[:, t] = np.vstack((u, curr_))[:, 0]
-
-        return self.components_[self.readout_idx_, self.discard_steps :].T
+        n_series, n_samples, n_features = xs.shape
+        self._check_backend()
+        self._init_weights(n_features)
+
+        # Time-major layout, each step is a contiguous (n_series, .) block.
+        # The projection of all steps of all series is a single GEMM.
+        x = np.ascontiguousarray(xs.swapaxes(0, 1)).reshape(-1, n_features)
+        states = np.empty((n_samples, n_series, self.n_components), dtype=xs.dtype)
+        if self.backend == "numpy":
+            Uproj = self._project(x).reshape(states.shape)
+            self._run(Uproj, states)
+        else:
+            self._run_device(x, states)
+        readout_idx = self.readout_idx_ - (1 + n_features)
+        return states[self.discard_steps :, :, readout_idx].swapaxes(0, 1)
@@ -1,6 +1,11 @@
+import sys
+import types
+
 import numpy as np
-from numpy.testing import assert_array_equal
+from numpy.testing import assert_allclose, assert_array_equal, assert_raises_regex
+from scipy import sparse
 
+from simple_esn import _reservoir
 from simple_esn.simple_esn import SimpleESN
 
 n_samples, n_features, n_readout = 10, 5, 2
@@ -58,3 +63,234 @@ def test_SimpleESN_transform():
 
     repeated_echoes = esn.transform(X)
     assert_array_equal(echoes, repeated_echoes)
+
+    assert_array_equal(esn.transform(X[:5]), echoes[:5])
+    assert_array_equal(esn.transform(X), echoes)
+
+
+def test_SimpleESN_spectral_radius():
+    # Random reservoirs have many eigenvalues of similar modulus, ARPACK may
+    # converge to a non-dominant one depending on the size and the seed
+    cases = [(20, 0), (200, 0), (1000, 1)] + [(500, seed) for seed in range(16)]
+    for n_components, seed in cases:
+        esn = SimpleESN(n_readout=n_readout, n_components=n_components,
+                        weight_scaling=0.9, random_state=seed)
+        esn.fit(X)
+        radius = np.max(np.abs(np.linalg.eigvals(esn.weights_)))
+        assert_allclose(radius, 0.9, rtol=1e-4)
+
+
+def _reference_echoes(esn, x):
+    curr = np.zeros(shape=(esn.n_components, 1))
+    states = []
+    for t in range(x.shape[0]):
+        u = np.concatenate(([1.0], x[t]))[:, None]
+        curr = (1 - esn.damping) * curr + esn.damping * np.tanh(
+            esn.input_weights_.dot(u) + esn.weights_.dot(curr)
+        )
+        states.append(np.concatenate((u, curr))[:, 0])
+    return np.array(states)[esn.discard_steps :, esn.readout_idx_]
+
+
+def test_SimpleESN_reference():
+    esn = SimpleESN(n_readout=n_readout, discard_steps=2, random_state=0)
+    echoes = esn.fit_transform(X)
+    assert_allclose(echoes, _reference_echoes(esn, X), atol=1e-5)
+
+
+def test_SimpleESN_fast_tanh():
+    echoes = SimpleESN(n_readout=n_readout, random_state=0).fit_transform(X)
+    esn = SimpleESN(n_readout=n_readout, random_state=0, fast_tanh=True)
+    fast_echoes = esn.fit_transform(X)
+    assert_allclose(fast_echoes, echoes, atol=0.05)
+
+
+def test_SimpleESN_dtype():
+    for dtype in (np.float32, np.float64):
+        esn = SimpleESN(n_readout=n_readout, dtype=dtype)
+        echoes = esn.fit_transform(X)
+        assert echoes.dtype == dtype
+        assert esn.weights_.dtype == dtype
+        assert esn.input_weights_.dtype == dtype
+
+    for dtype in (np.float16, np.int64):
+        esn = SimpleESN(n_readout=n_readout, dtype=dtype)
+        with assert_raises_regex(ValueError, "dtype"):
+            esn.fit_transform(X)
+        assert esn.weights_ is None
+
+
+def test_SimpleESN_sparse():
+    esn = SimpleESN(n_readout=n_readout, n_components=200, density=0.05,
+                    random_state=0)
+    echoes = esn.fit_transform(X)
+    assert sparse.issparse(esn.weights_)
+    assert esn.weights_.nnz == 2000
+    assert_allclose(echoes, _reference_echoes(esn, X), atol=1e-5)
+
+
+def test_SimpleESN_sparse_small():
+    # Most draws of such reservoirs have no cycle, hence a zero spectral
+    # radius, they are drawn again
+    for seed in range(20):
+        esn = SimpleESN(n_readout=n_readout, n_components=20, density=0.02,
+                        random_state=seed)
+        echoes = esn.fit_transform(X)
+        assert np.all(np.isfinite(echoes))
+        radius = np.max(np.abs(np.linalg.eigvals(esn.weights_.toarray())))
+        assert_allclose(radius, esn.weight_scaling, rtol=1e-3)
+
+    for density in (0, -0.1, 1.5):
+        with assert_raises_regex(ValueError, "density"):
+            SimpleESN(n_readout=n_readout, density=density).fit(X)
+    with assert_raises_regex(ValueError, "zero spectral radius"):
+        SimpleESN(n_readout=n_readout, n_components=20, density=1e-3,
+                  random_state=0).fit(X)
+
+
+def test_SimpleESN_batch():
+    n_series, discard_steps = 3, 2
+    xs = rng_global.randn(n_series, n_samples, n_features)
+    for density in (1.0, 0.05):
+        esn = SimpleESN(n_readout=n_readout, discard_steps=discard_steps,
+                        density=density, random_state=0)
+        echoes = esn.fit_transform_batch(xs)
+        assert echoes.shape == (n_series, n_samples - discard_steps, n_readout)
+        for x, x_echoes in zip(xs, echoes):
+            assert_allclose(x_echoes, esn.transform(x), atol=1e-5)
+
+
+def test_SimpleESN_diagonal():
+    esn = SimpleESN(n_readout=n_readout, mode="diagonal", dtype=np.float64,
+                    random_state=0)
+    echoes = esn.fit_transform(X)
+    assert esn.weights_.shape == (esn.n_components,)
+    assert_allclose(np.max(np.abs(esn.weights_)), esn.weight_scaling)
+
+    h = np.zeros(esn.n_components, dtype=complex)
+    states = []
+    for x in X:
+        u = esn.input_weights_.dot(np.concatenate(([1.0], x)))
+        h = (1 - esn.damping) * h + esn.damping * (esn.weights_ * h + u)
+        states.append(np.tanh(esn.mixing_weights_.dot(h.real)))
+    readout_idx = esn.readout_idx_ - (1 + n_features)
+    assert_allclose(echoes, np.array(states)[:, readout_idx])
+
+    xs = rng_global.randn(3, n_samples, n_features)
+    assert esn.fit_transform_batch(xs).shape == (3, n_samples, n_readout)
+
+    # The linear recurrence diverges for eigenvalues outside the unit disk
+    esn = SimpleESN(n_readout=n_readout, mode="diagonal", weight_scaling=1.25)
+    with assert_raises_regex(ValueError, "weight_scaling"):
+        esn.fit_transform(X)
+    esn = SimpleESN(n_readout=n_readout, mode="diagonal", density=0.1)
+    with assert_raises_regex(ValueError, "density"):
+        esn.fit_transform(X)
+
+
+def test_SimpleESN_check_input():
+    echoes = SimpleESN(n_readout=n_readout, random_state=0).fit_transform(X)
+    esn = SimpleESN(n_readout=n_readout, random_state=0, check_input=False)
+    assert_array_equal(esn.fit_transform(X), echoes)
+
+
+def test_reservoir_kernels():
+    # Compiled (Cython), numba and plain Python kernels of the dense
+    # recurrence, whichever are available, give the same states
+    n_components = 50
+    rng = np.random.RandomState(0)
+    W = (rng.rand(n_components, n_components) - 0.5) / 10
+    Uproj = rng.randn(n_samples, n_components)
+    kernels = [_reservoir._run_dense]
+    if hasattr(_reservoir._run_dense, "py_func"):
+        kernels.append(_reservoir._run_dense.py_func)
+    if _reservoir._run_compiled is not None:
+        kernels.append(_reservoir._run_compiled)
+    for dtype in (np.float32, np.float64):
+        for fast_tanh in (False, True):
+            results = []
+            for kernel in kernels:
+                states = np.empty((n_samples, n_components), dtype=dtype)
+                kernel(Uproj.astype(dtype), W.astype(dtype), dtype(0.5),
+                       states, fast_tanh)
+                results.append(states)
+            for states in results[1:]:
+                assert_allclose(states, results[0], atol=1e-6)
+
+
+def test_gpu_recurrence():
+    # The device loop only uses the array API shared with numpy, check it
+    # on CPU against the reference kernels
+    for density in (1.0, 0.1):
+        for fast_tanh in (False, True):
+            esn = SimpleESN(n_readout=n_readout, density=density,
+                            fast_tanh=fast_tanh, random_state=0)
+            esn.fit(X)
+            Uproj = esn._project(X.astype(np.float32))
+            damping = np.float32(esn.damping)
+            states = np.empty_like(Uproj)
+            _reservoir._run_reservoir(Uproj.copy(), esn.weights_, damping,
+                                      states, fast_tanh)
+            gpu_states = _reservoir._gpu_recurrence(
+                np, Uproj[:, np.newaxis, :], esn.weights_, float(damping),
+                fast_tanh,
+            )
+            assert_allclose(gpu_states[:, 0], states, atol=1e-6)
+
+
+def test_gpu_diagonal():
+    # The parallel scan of the device gives the states of the sequential
+    # recurrence
+    for fast_tanh in (False, True):
+        esn = SimpleESN(n_readout=n_readout, mode="diagonal",
+                        fast_tanh=fast_tanh, random_state=0)
+        esn.fit(X)
+        Uproj = esn._project(X.astype(np.float32))
+        damping = np.float32(esn.damping)
+        states = np.empty_like(Uproj)
+        _reservoir._run_diagonal(Uproj, esn.weights_, esn.mixing_weights_,
+                                 damping, states, fast_tanh)
+        gpu_states = _reservoir._gpu_diagonal(
+            np, Uproj[:, np.newaxis, :], esn.weights_, esn.mixing_weights_,
+            float(damping), fast_tanh,
+        )
+        assert gpu_states.dtype == np.float32
+        assert_allclose(gpu_states[:, 0], states, atol=1e-5)
+
+
+def test_SimpleESN_backend_errors():
+    esn = SimpleESN(n_readout=n_readout, backend="foo")
+    with assert_raises_regex(ValueError, "backend"):
+        esn.fit_transform(X)
+    # Checked before drawing the weights
+    assert esn.weights_ is None
+
+    for backend in ("cupy", "torch"):
+        module = sys.modules.get(backend)
+        sys.modules[backend] = None
+        try:
+            esn = SimpleESN(n_readout=n_readout, backend=backend)
+            with assert_raises_regex(ImportError, backend):
+                esn.transform(X)
+            assert esn.weights_ is None
+        finally:
+            if module is None:
+                del sys.modules[backend]
+            else:
+                sys.modules[backend] = module
+
+    # Installed without a CUDA device
+    module = sys.modules.get("torch")
+    fake_torch = types.ModuleType("torch")
+    fake_torch.cuda = types.SimpleNamespace(is_available=lambda: False)
+    sys.modules["torch"] = fake_torch
+    try:
+        esn = SimpleESN(n_readout=n_readout, backend="torch")
+        with assert_raises_regex(RuntimeError, "CUDA"):
+            esn.fit_transform(X)
+        assert esn.weights_ is None
+    finally:
+        if module is None:
+            del sys.modules["torch"]
+        else:
+            sys.modules["torch"] = module